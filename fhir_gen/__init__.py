@@ -1,4 +1,2 @@
-from . import patch
-
 from .definitions import *
 from .rendering import *
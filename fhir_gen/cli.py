@@ -1,27 +1,71 @@
 import os
 import sys
 import logging
+import hashlib
+import pickle
 from typing import Optional
 
-from jsonargparse import CLI
-
 from .definitions import Definitions
-from .parsing import Config as ParserConfig, Parser
+from .parsing import Config as ParserConfig, Output as ParserOutput, Parser
 from .rendering import Config as RendererConfig, Renderer
 
 
+# Bump whenever parsing changes or the pickled state of parsing.Output does,
+# cached output from older versions is then ignored
+PARSED_CACHE_VERSION = 1
+
+
+def parsed_cache_key(definitions: Definitions, parser: ParserConfig) -> str:
+    key = (
+        PARSED_CACHE_VERSION,
+        pickle.HIGHEST_PROTOCOL,
+        definitions.url,
+        definitions.version,
+        definitions.sources,
+        parser.base_url,
+        sorted(parser.mappings.items()),
+    )
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+
 def generate(
     definitions: Definitions,
     renderer: RendererConfig,
     parser: ParserConfig,
     cache_dir: Optional[str] = None,
+    no_cache: bool = False,
 ):
     parser_ = Parser(parser)
     renderer_ = Renderer(renderer)
-    renderer_(parser_(definitions.iter_resources(cache_dir=cache_dir)))
+
+    # Definitions are immutable per version, the parsed output is cached next
+    # to the downloaded definitions.
+    output: Optional[ParserOutput] = None
+    cache_file: Optional[str] = None
+
+    if cache_dir is not None and not no_cache:
+        cache_file = os.path.join(
+            cache_dir, f"parsed-{parsed_cache_key(definitions, parser)}.pkl"
+        )
+        if os.path.exists(cache_file):
+            with open(cache_file, "rb") as f:
+                output = pickle.load(f)
+
+    if output is None:
+        output = parser_(definitions.iter_resources(cache_dir=cache_dir))
+
+        if cache_file is not None:
+            with open(f"{cache_file}.tmp", "wb") as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{cache_file}.tmp", cache_file)
+
+    renderer_(output)
 
 
 def main():
+    # Imported here, it is only needed to run the command line interface
+    from jsonargparse import CLI
+
     sys.path.append(os.getcwd())
     logging.basicConfig(
         level=logging.WARN,
@@ -1,26 +1,194 @@
-from typing import Optional, List, Sequence, Literal, Union, Iterator, Dict, overload
+from typing import (
+    Optional,
+    List,
+    Sequence,
+    Literal,
+    Union,
+    Iterator,
+    Dict,
+    Mapping,
+    Callable,
+    Any,
+    Type,
+    TypeVar,
+    overload,
+    get_args,
+    get_origin,
+)
 from urllib.parse import urlsplit
 import requests
 import os.path
+import sys
 import tempfile
 import zipfile
 import contextlib
-import json
+import concurrent.futures
+import functools
+import orjson
 
 import dataclasses
-from dataclass_wizard import JSONWizard
+
+
+TAG_KEY = "resourceType"
+
+
+Decoder = Callable[[Any], Any]
+
+
+_decoders: Dict[Any, Optional[Decoder]] = {}
+
+
+def _decoder(tp: Any) -> Optional[Decoder]:
+    # `None` means JSON values are used as-is
+    if tp not in _decoders:
+        _decoders[tp] = _build_decoder(tp)
+    return _decoders[tp]
+
+
+def _build_decoder(tp: Any) -> Optional[Decoder]:
+    if dataclasses.is_dataclass(tp):
+        return _build_dataclass_decoder(tp)
+
+    origin, args = get_origin(tp), get_args(tp)
+
+    if origin is Literal or (
+        origin is Union
+        and all(get_origin(arg) is Literal or arg is type(None) for arg in args)
+    ):
+        return _build_literal_decoder(tp)
+
+    if origin is Union:
+        optional = type(None) in args
+        args = tuple(arg for arg in args if arg is not type(None))
+        decode = (
+            _decoder(args[0]) if len(args) == 1 else _build_tagged_union_decoder(args)
+        )
+        if decode is None or not optional:
+            return decode
+        return lambda value: None if value is None else decode(value)
+
+    if origin is list:
+        decode_item = _decoder(args[0])
+        if decode_item is None:
+            return None
+        return lambda values: [decode_item(value) for value in values]
+
+    return None
+
+
+def _build_literal_decoder(tp: Any) -> Decoder:
+    values = set()
+    for arg in get_args(tp) if get_origin(tp) is Union else [tp]:
+        values.update(get_args(arg) if arg is not type(None) else [None])
+
+    def decode(value):
+        if value not in values:
+            raise ValueError(value)
+        return value
+
+    return decode
+
+
+def _build_tagged_union_decoder(args: Sequence[Any]) -> Decoder:
+    if not all(dataclasses.is_dataclass(arg) for arg in args):
+        raise TypeError(args)
+
+    decoders: Dict[str, Decoder] = {}
+    for arg in args:
+        decoder = _decoder(arg)
+        # Dataclasses always get a decoder
+        assert decoder is not None
+        decoders[arg.__name__] = decoder
+
+    def decode(value):
+        tag = value[TAG_KEY]
+        if tag not in decoders:
+            raise ValueError(tag)
+        return decoders[tag](value)
+
+    return decode
+
+
+def _build_dataclass_decoder(cls: Any) -> Decoder:
+    # Generate a specialized function per dataclass, instead of dispatching on
+    # the field types for every decoded value.
+    namespace: Dict[str, Any] = {"cls": cls}
+    required: List[str] = []
+    optional: List[str] = []
+
+    for field in dataclasses.fields(cls):
+        if not field.init:
+            continue
+
+        # Fields may be read from a differently named JSON key
+        key = field.metadata.get("alias", field.name)
+        value = f"d[{key!r}]"
+        decode = _decoder(field.type)
+        if decode is not None:
+            namespace[f"_decode_{field.name}"] = decode
+            value = f"_decode_{field.name}({value})"
+
+        if (
+            field.default is dataclasses.MISSING
+            and field.default_factory is dataclasses.MISSING
+        ):
+            required.append(f"{field.name!r}: {value}")
+        else:
+            optional += [
+                f"    if {key!r} in d:",
+                f"        kwargs[{field.name!r}] = {value}",
+            ]
+
+    name = f"_decode_{cls.__name__}"
+    source = "\n".join(
+        [
+            f"def {name}(d):",
+            f"    kwargs = {{{', '.join(required)}}}",
+            *optional,
+            "    return cls(**kwargs)",
+        ]
+    )
+    exec(source, namespace)
+    return namespace[name]
+
+
+T_Base = TypeVar("T_Base", bound="Base")
 
 
 class Base:
-    pass
+
+    @classmethod
+    def from_dict(cls: Type[T_Base], data: Mapping[str, Any]) -> T_Base:
+        decode = _decoder(cls)
+        assert decode is not None
+        return decode(data)
+
+    @classmethod
+    def from_bytes(cls: Type[T_Base], raw: bytes) -> T_Base:
+        return cls.from_dict(orjson.loads(raw))
 
 
 class Path(Sequence):
+    __slots__ = ("_parts", "_str", "_hash")
+
     def __init__(self, value: Union[str, Sequence[str]]) -> None:
-        self._parts = value.split(".") if isinstance(value, str) else list(value)
+        # Parts are interned, comparing them mostly comes down to identity checks
+        self._parts = tuple(
+            map(sys.intern, value.split(".") if isinstance(value, str) else value)
+        )
+        self._str = ".".join(self._parts)
+        self._hash = hash(self._parts)
+
+    @staticmethod
+    def _parts_of(other: object):
+        if isinstance(other, Path):
+            return other._parts
+        if isinstance(other, str):
+            return tuple(other.split("."))
+        raise TypeError(type(other))
 
     def __str__(self) -> str:
-        return ".".join(self._parts)
+        return self._str
 
     @overload
     def __getitem__(self, key: int) -> str: ...
@@ -39,30 +207,26 @@ class Path(Sequence):
     def __repr__(self):
         return repr(self._parts)
 
+    def __hash__(self) -> int:
+        return self._hash
+
     def __eq__(self, other: object):
-        if isinstance(other, (Path, str)):
-            return str(self) == str(other)
+        if isinstance(other, Path):
+            return self._parts == other._parts
+        if isinstance(other, str):
+            return self._str == other
         raise TypeError(type(other))
 
     def __gt__(self, other: object):
-        if isinstance(other, (Path, str)):
-            other = Path(str(other))
-            return len(self) > len(other) and self[: len(other)] == other
-
-        raise TypeError(type(other))
+        parts = self._parts_of(other)
+        return len(self._parts) > len(parts) and self._parts[: len(parts)] == parts
 
     def __gte__(self, other: object):
-        if isinstance(other, (Path, str)):
-            other = Path(str(other))
-            return len(self) >= len(other) and self[: len(other)] == other
-
-        raise TypeError(type(other))
+        parts = self._parts_of(other)
+        return len(self._parts) >= len(parts) and self._parts[: len(parts)] == parts
 
     def __add__(self, other: object):
-        if isinstance(other, (Path, str)):
-            return Path([*self, *Path(other)])
-
-        raise TypeError(type(other))
+        return Path(self._parts + self._parts_of(other))
 
 
 @dataclasses.dataclass(kw_only=True)
@@ -120,7 +284,9 @@ class StructureDefinition(Resource):
     url: str
     name: str
     type: str
-    snapshot: Snapshot
+    # Decoded on access, the element definitions of resources which are never
+    # parsed are not materialized.
+    snapshot_raw: Dict = dataclasses.field(metadata={"alias": "snapshot"}, repr=False)
     abstract: bool
     kind: Union[
         Literal["primitive-type"],
@@ -132,6 +298,10 @@ class StructureDefinition(Resource):
     derivation: Optional[Union[Literal["specialization"], Literal["constraint"]]] = None
     baseDefinition: Optional[str] = None
 
+    @functools.cached_property
+    def snapshot(self) -> Snapshot:
+        return self.Snapshot.from_dict(self.snapshot_raw)
+
 
 @dataclasses.dataclass(kw_only=True)
 class ValueSet(Resource):
@@ -178,13 +348,14 @@ class Bundle(Resource):
 
 
 @dataclasses.dataclass(kw_only=True)
-class Container(JSONWizard):
-    class _(JSONWizard.Meta):
-        tag_key = "resourceType"
-        auto_assign_tags = True
-
+class Container(Base):
     root: Union[StructureDefinition, Bundle]
 
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "Container":
+        # Documents hold the root resource itself
+        return cls.from_dict({"root": orjson.loads(raw)})
+
 
 class Definitions:
 
@@ -199,7 +370,7 @@ class Definitions:
         self.sources = list(sources)
 
     def iter_containers(
-        self, *, cache_dir: Optional[str], chunk_size: int = 512
+        self, *, cache_dir: Optional[str], chunk_size: int = 256 * 1024
     ) -> Iterator[Container]:
 
         if cache_dir is not None and not os.path.exists(cache_dir):
@@ -227,14 +398,24 @@ class Definitions:
 
             assert os.path.exists(fname)
 
-            with zipfile.ZipFile(fname, mode="r") as zip:
-                for name in self.sources:
-                    root = json.load(zip.open(name))
+            # Sources are decompressed and decoded concurrently, but yielded in
+            # their configured order.
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count()
+            ) as executor:
+                yield from executor.map(
+                    functools.partial(self.load_container, fname), self.sources
+                )
+
+    @staticmethod
+    def load_container(fname: str, name: str) -> Container:
+        # ZipFile is not safe to share between threads, open one per source.
+        with zipfile.ZipFile(fname, mode="r") as zip:
+            container = Container.from_bytes(zip.read(name))
 
-                    container = Container.from_dict({"root": root})
-                    assert isinstance(container, Container)
+        assert isinstance(container, Container)
 
-                    yield container
+        return container
 
     def iter_resources(self, *args, **kwargs):
         for container in self.iter_containers(*args, **kwargs):
@@ -4,24 +4,22 @@ from typing import (
     Mapping,
     Dict,
     Optional,
-    Callable,
     Hashable,
     List,
     Any,
-    Deque,
-    Generator,
     Tuple,
+    FrozenSet,
+    Set,
 )
 import dataclasses
 import collections
-import contextlib
-import itertools
+import graphlib
 
 from . import definitions
 from .utils import Visitor
 
 
-@dataclasses.dataclass(kw_only=True, frozen=True)
+@dataclasses.dataclass(kw_only=True, frozen=True, slots=True)
 class FHIRType(Hashable):
     url: str
     name: str
@@ -33,19 +31,19 @@ class FHIRType(Hashable):
             raise ValueError(self.name)
 
     @property
-    def dependencies(self):
-        return set([self.base] if self.base else [])
+    def dependencies(self) -> FrozenSet["FHIRType"]:
+        return frozenset([self.base] if self.base else [])
 
     def __hash__(self) -> int:
         return hash((self.url, self.name))
 
 
-@dataclasses.dataclass(kw_only=True, frozen=True, eq=False)
+@dataclasses.dataclass(kw_only=True, frozen=True, eq=False, slots=True)
 class FHIRPrimitiveType(FHIRType):
     pass
 
 
-@dataclasses.dataclass(kw_only=True, frozen=True)
+@dataclasses.dataclass(kw_only=True, frozen=True, slots=True)
 class FHIRProperty:
     name: str
     min: int
@@ -54,65 +52,123 @@ class FHIRProperty:
     type: Sequence[FHIRType]
 
 
-@dataclasses.dataclass(kw_only=True, frozen=True, eq=False)
+@dataclasses.dataclass(kw_only=True, frozen=True, eq=False, slots=True)
 class FHIRComplexType(FHIRType):
     properties: List[FHIRProperty] = dataclasses.field(default_factory=list)
+    _dependencies: Optional[FrozenSet[FHIRType]] = dataclasses.field(
+        default=None, init=False, repr=False
+    )
+
+    def finalize(self):
+        # Called once all properties have been added
+        object.__setattr__(self, "_dependencies", self.dependencies)
 
     @property
-    def dependencies(self):
-        return set(
-            [
-                *super().dependencies,
-                *itertools.chain(*(prop.type for prop in self.properties)),
-            ]
-        )
+    def dependencies(self) -> FrozenSet[FHIRType]:
+        if self._dependencies is not None:
+            return self._dependencies
 
+        # slots=True replaces the class, zero-argument super() would refer to
+        # the original one
+        dependencies = set(super(FHIRComplexType, self).dependencies)
+        for prop in self.properties:
+            dependencies.update(prop.type)
+        return frozenset(dependencies)
 
-@dataclasses.dataclass(kw_only=True)
+
+@dataclasses.dataclass(kw_only=True, slots=True)
 class Context:
     path: definitions.Path = dataclasses.field(
         default_factory=lambda: definitions.Path([])
     )
-    stack: Deque = dataclasses.field(default_factory=collections.deque)
+    stack: List = dataclasses.field(default_factory=list)
     scope: Any = None
 
 
-@dataclasses.dataclass(kw_only=True)
+@dataclasses.dataclass(kw_only=True, slots=True)
 class Output:
     types: List[FHIRType]
 
+    # Types refer to each other in cycles, pickling them as is would recurse
+    # along every reference. They are stored flat, referring to each other by
+    # their index instead. Changing this layout requires bumping
+    # cli.PARSED_CACHE_VERSION.
+    def __getstate__(self):
+        index = {id(type): i for i, type in enumerate(self.types)}
+        return [
+            (
+                type.__class__,
+                type.url,
+                type.name,
+                type.inline,
+                None if type.base is None else index[id(type.base)],
+                [
+                    (prop.name, prop.min, prop.max, [index[id(t)] for t in prop.type])
+                    for prop in getattr(type, "properties", [])
+                ],
+            )
+            for type in self.types
+        ]
+
+    def __setstate__(self, state):
+        types = [cls.__new__(cls) for cls, *_ in state]
+
+        for type, (_, url, name, inline, base, properties) in zip(types, state):
+            values: Dict[str, Any] = dict(
+                url=url,
+                name=name,
+                inline=inline,
+                base=None if base is None else types[base],
+            )
+            if isinstance(type, FHIRComplexType):
+                values["properties"] = [
+                    FHIRProperty(
+                        name=name, min=min, max=max, type=[types[i] for i in type_]
+                    )
+                    for name, min, max, type_ in properties
+                ]
+                values["_dependencies"] = None
 
-@dataclasses.dataclass
-class Config:
-    base_url: str
-    mappings: Mapping[str, str] = dataclasses.field(default_factory=dict)
+            for name, value in values.items():
+                object.__setattr__(type, name, value)
 
+        for type in types:
+            if isinstance(type, FHIRComplexType):
+                type.finalize()
 
-class Instruction:
-    pass
+        self.types = types
 
 
-class Requirement(Instruction):
-    def __init__(self, predicate: Callable[[], bool]) -> None:
-        self._predicate = predicate
+@dataclasses.dataclass(slots=True)
+class Config:
+    base_url: str
+    mappings: Mapping[str, str] = dataclasses.field(default_factory=dict)
 
-    def __call__(self) -> bool:
-        return self._predicate()
 
+class ContextGuard:
+    # Pushes a context for the duration of a with block, without the generator
+    # frame contextlib.contextmanager would set up for every element.
+    __slots__ = ("_contexts", "_context")
 
-VisitOutput = Generator[Instruction, Any, Any]
+    def __init__(self, contexts: List[Context], context: Context) -> None:
+        self._contexts = contexts
+        self._context = context
 
+    def __enter__(self) -> None:
+        self._contexts.append(self._context)
 
-Task = Tuple[definitions.Base, VisitOutput, Optional[Instruction]]
+    def __exit__(self, *exc_info) -> None:
+        assert self._contexts.pop() is self._context
 
 
-class Parser(Visitor[definitions.Base, VisitOutput]):
+class Parser(Visitor[definitions.Base, Any]):
 
-    _contexts: Deque[Context]
-    _types: List[FHIRType]
+    _contexts: List[Context]
+    _types: Dict[Tuple[str, str], FHIRType]
     _resolved_types: Dict[str, FHIRType]
 
     def __init__(self, config: Config) -> None:
+        super().__init__()
         self._base_url = config.base_url
         if self._base_url.endswith("/"):
             raise ValueError(self._base_url)
@@ -123,87 +179,102 @@ class Parser(Visitor[definitions.Base, VisitOutput]):
         return self._contexts[-1]
 
     def append_type(self, type: FHIRType):
-        assert type not in self._types, type.name
-        self._types.append(type)
-        self.resolve_type(type)
+        key = (type.url, type.name)
+        assert key not in self._types, type.name
+        self._types[key] = type
 
     def resolve_type(self, type: FHIRType):
         if not type.inline:
             self._resolved_types[type.url] = type
 
     def new_context(self, **updates):
-        return Context(**{**dataclasses.asdict(self.context), **updates})
+        # Each context owns its stack, everything else is shared
+        return dataclasses.replace(
+            self.context, **{"stack": self.context.stack.copy(), **updates}
+        )
 
-    def require_type(self, url: str) -> VisitOutput:
-        if url in self._mappings:
-            url = self._mappings[url]
+    def map_url(self, url: str) -> str:
+        return self._mappings.get(url, url)
 
-        if url not in self._resolved_types:
-            yield Requirement(lambda: url in self._resolved_types)
+    def require_type(self, url: str) -> FHIRType:
+        url = self._mappings.get(url, url)
+        type = self._resolved_types.get(url)
+        if type is None:
+            raise ValueError(url)
 
-        return self._resolved_types[url]
+        return type
 
-    @contextlib.contextmanager
     def with_context(self, context: Context):
-        self._contexts.append(context)
-        yield None
-        assert self._contexts.pop() is context
+        return ContextGuard(self._contexts, context)
 
-    def visit_CodeSystem(self, node: definitions.CodeSystem) -> VisitOutput:
-        yield from ()
+    def visit_CodeSystem(self, node: definitions.CodeSystem) -> None:
+        pass
 
-    def visit_ValueSet(self, node: definitions.ValueSet) -> VisitOutput:
-        yield from ()
+    def visit_ValueSet(self, node: definitions.ValueSet) -> None:
+        pass
 
     def parse_FHIRComplexType_ElementDefinitions(
         self,
         current: FHIRComplexType,
-        nodes: Iterable[definitions.ElementDefinition],
+        children: Mapping[definitions.Path, List[definitions.ElementDefinition]],
         path: definitions.Path,
-    ) -> VisitOutput:
-        remaining: List[definitions.ElementDefinition] = []
-
-        with self.with_context(self.new_context(scope=current, path=path)):
-
-            inline_properties: Dict[str, List[Mapping]] = collections.defaultdict(list)
-
-            for node in nodes:
-                out = yield from self.visit(node)
-                if out is NotImplemented:
-                    if self.context.stack:
-                        prop_values = self.context.stack.pop()
-                        inline_properties[prop_values["name"]].append(prop_values)
-                    else:
-                        remaining.append(node)
-
-            for prop_name, prop_values in inline_properties.items():
-                prop_values = prop_values[0]
-                if len(prop_values) > 1:
-                    # TODO: handle this
-                    pass
+    ):
+        context = self.new_context(scope=current, path=path)
+
+        with self.with_context(context):
+
+            inline_properties: List[Tuple[str, Mapping]] = []
+            seen: Set[str] = set()
+
+            for node in children.get(path, []):
+                out = self.visit(node)
+                if out is NotImplemented and context.stack:
+                    prop_values = context.stack.pop()
+                    # Slices repeat the path of the sliced element, the first
+                    # one defines the inline type
+                    if prop_values["name"] not in seen:
+                        seen.add(prop_values["name"])
+                        inline_properties.append((prop_values["name"], prop_values))
+
+            for prop_name, prop_values in inline_properties:
                 name = f"{current.name}{prop_name.capitalize()}"
                 inline = FHIRComplexType(name=name, url=current.url, inline=True)
-                path = self.context.path + prop_name
-                nodes = list(filter(lambda elt: elt.path > path, remaining))
-                remaining = [node for node in remaining if node not in nodes]
 
-                remaining += yield from self.parse_FHIRComplexType_ElementDefinitions(
+                self.parse_FHIRComplexType_ElementDefinitions(
                     inline,
-                    nodes,
-                    path=path,
+                    children,
+                    path=context.path + prop_name,
                 )
 
-                self.context.scope.properties.append(
+                context.scope.properties.append(
                     FHIRProperty(type=[inline], **prop_values)
                 )
 
                 self.append_type(inline)
 
-        return remaining
+    def parse_StructureDefinition_ElementDefinitions(
+        self, current: FHIRComplexType, node: definitions.StructureDefinition
+    ):
+        # Group element definitions by the path of their parent once, instead
+        # of filtering the remaining ones for every inline type.
+        children: Dict[definitions.Path, List[definitions.ElementDefinition]] = (
+            collections.defaultdict(list)
+        )
+        for child in node.snapshot.element:
+            children[child.path[:-1]].append(child)
+
+        # Constraints are rooted at the path of the type they constrain
+        cursor = current
+        while cursor is not None:
+            path = self.context.path + cursor.name
+            if path in children:
+                self.parse_FHIRComplexType_ElementDefinitions(
+                    current, children, path=path
+                )
+                break
+            cursor = cursor.base
 
-    def visit_StructureDefinition(
-        self, node: definitions.StructureDefinition
-    ) -> VisitOutput:
+    def visit_StructureDefinition(self, node: definitions.StructureDefinition) -> Any:
 
         current: Optional[FHIRType] = None
 
@@ -219,7 +290,7 @@ class Parser(Visitor[definitions.Base, VisitOutput]):
                 return NotImplemented
 
         if node.baseDefinition:
-            values["base"] = yield from self.require_type(node.baseDefinition)
+            values["base"] = self.require_type(node.baseDefinition)
 
         if node.kind == "complex-type":
             current = FHIRComplexType(**values)
@@ -228,40 +299,24 @@ class Parser(Visitor[definitions.Base, VisitOutput]):
         elif node.kind == "resource":
             current = FHIRComplexType(**values)
 
-        if isinstance(current, FHIRComplexType):
-            nodes = list(
-                filter(
-                    lambda node: isinstance(node, definitions.ElementDefinition),
-                    node.snapshot.element,
-                )
-            )
-
-            cursor = current
-            while cursor is not None and nodes:
-                nodes = yield from self.parse_FHIRComplexType_ElementDefinitions(
-                    current,
-                    nodes,
-                    path=self.context.path + cursor.name,
-                )
-                cursor = cursor.base
-
         if isinstance(current, FHIRType):
-            self.append_type(current)
+            self.resolve_type(current)
 
-    def visit_ElementDefinition(
-        self, node: definitions.ElementDefinition
-    ) -> VisitOutput:
+        return current
+
+    def visit_ElementDefinition(self, node: definitions.ElementDefinition) -> Any:
+        context = self.context
         assert node.id
-        assert self.context.path
-        assert self.context.scope is not None
+        assert context.path
+        assert context.scope is not None
 
-        if node.path == self.context.path:
+        if node.path == context.path:
             return
 
-        elif node.path > self.context.path:
-            parts = node.path[len(self.context.path) :]
-            if len(parts) == 1:
-                assert isinstance(self.context.scope, FHIRComplexType)
+        elif node.path > context.path:
+            # Direct children only, without slicing out a new Path
+            if len(node.path) == len(context.path) + 1:
+                assert isinstance(context.scope, FHIRComplexType)
                 types = []
 
                 property_name = node.path[-1]
@@ -276,63 +331,78 @@ class Parser(Visitor[definitions.Base, VisitOutput]):
                 for child in node.type:
                     if child.code == "BackboneElement":
                         assert len(node.type) == 1
-                        self.context.stack.append(values)
+                        context.stack.append(values)
                         return NotImplemented
 
-                    out = yield from self.visit(child)
+                    out = self.visit(child)
 
                     if out is not NotImplemented:
-                        type = yield from self.require_type(self.context.stack.pop())
+                        type = self.require_type(context.stack.pop())
                         types.append(type)
 
                 if types:
-                    self.context.scope.properties.append(
-                        FHIRProperty(type=types, **values)
-                    )
+                    context.scope.properties.append(FHIRProperty(type=types, **values))
 
                 return
 
         return NotImplemented
 
-    def visit_Type(self, node: definitions.ElementDefinition.Type) -> VisitOutput:
-        if isinstance(self.context.scope, FHIRType):
+    def visit_Type(self, node: definitions.ElementDefinition.Type) -> None:
+        context = self.context
+        if isinstance(context.scope, FHIRType):
             assert node.code != "BackboneElement"
             if node.code.startswith("http://"):
                 url = node.code
             else:
                 url = f"{self._base_url}/StructureDefinition/{node.code}"
-            self.context.stack.append(url)
-
-        yield from ()
+            context.stack.append(url)
 
     def __call__(self, nodes: Iterable[definitions.Base]) -> Output:
 
-        self._contexts = collections.deque([Context()])
+        self._contexts = [Context()]
         self._resolved_types = {}
-        self._types = []
-
-        tasks: Sequence[Task] = [(node, self.visit(node), None) for node in nodes]
-
-        while tasks:
-            next_tasks: Sequence[Task] = []
-            for node, gen, prev in tasks:
-                if not isinstance(gen, Generator):
-                    assert gen is NotImplemented
-                    continue
+        self._types = {}
+
+        # Types are created in inheritance order, so base types are resolved
+        # before their subtypes. Properties may refer to types in cycles, so
+        # they are only parsed once every type exists.
+        structure_definitions: Dict[str, definitions.StructureDefinition] = {}
+        sorter: graphlib.TopologicalSorter[str] = graphlib.TopologicalSorter()
+
+        for node in nodes:
+            if isinstance(node, definitions.StructureDefinition):
+                assert node.url not in structure_definitions, node.url
+                structure_definitions[node.url] = node
+                sorter.add(
+                    node.url,
+                    *(
+                        [self.map_url(node.baseDefinition)]
+                        if node.baseDefinition
+                        else []
+                    ),
+                )
+            else:
+                self.visit(node)
 
-                instruction = next(gen, None) if prev is None else prev
-                if instruction is None:
-                    continue
+        parsed: List[Tuple[definitions.StructureDefinition, FHIRType]] = []
 
-                if isinstance(instruction, Requirement) and instruction():
-                    # Requirement met
-                    instruction = None
+        for url in sorter.static_order():
+            # Unknown base definitions are reported by require_type
+            if url not in structure_definitions:
+                continue
 
-                next_tasks.append((node, gen, instruction))
+            node = structure_definitions[url]
+            current = self.visit(node)
+            if isinstance(current, FHIRType):
+                parsed.append((node, current))
 
-            if tasks == next_tasks:
-                raise RuntimeError()
+        for node, current in parsed:
+            if isinstance(current, FHIRComplexType):
+                self.parse_StructureDefinition_ElementDefinitions(current, node)
+            self.append_type(current)
 
-            tasks = next_tasks
+        for type in self._types.values():
+            if isinstance(type, FHIRComplexType):
+                type.finalize()
 
-        return Output(types=list(self._types))
+        return Output(types=list(self._types.values()))
@@ -1,13 +1,15 @@
-from typing import Mapping, Iterable, Sequence, Callable, Optional
+from typing import Mapping, Iterable, Sequence, Callable, Optional, Dict, Tuple, Union
 import abc
+import concurrent.futures
+import contextlib
+import hashlib
+import json
 import os
 import os.path
-from pathlib import Path
-import shutil
 import dataclasses
 
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 from . import parsing
 
@@ -20,12 +22,15 @@ class Context(metaclass=abc.ABCMeta):
     def __call__(self, input: RenderInput, variables: Mapping) -> Iterable[Mapping]: ...
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Artifact:
     template_file: str
     output_file: str
     context: Context
     post_process: Optional[Callable[[str], str]] = None
+    # Run post_process in a worker process, for expensive (CPU-bound)
+    # post-processing. post_process must be picklable.
+    post_process_in_process: bool = False
 
 
 class Preset:
@@ -36,49 +41,179 @@ class Preset:
     def setup(self, env: Environment): ...
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Config:
     preset: Preset
     output_dir: str
     variables: Mapping = dataclasses.field(default_factory=dict)
 
 
-class Renderer:
+MANIFEST_FILE = ".fhir_gen_manifest.json"
 
-    def __init__(self, config: Config) -> None:
-        self.output_dir = os.path.abspath(config.output_dir)
-        self.variables = dict(config.variables)
-        self.preset = config.preset
 
-    def __call__(self, input: RenderInput):
+def _load_manifest(output_dir: str) -> Dict[str, Tuple[str, int]]:
+    # Maps output files (relative to output_dir) to the digest of their content
+    # and their mtime after the last write
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE), "rb") as f:
+            return {name: tuple(entry) for name, entry in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
 
-        env = Environment(loader=FileSystemLoader(self.preset.root_dir))
-        self.preset.setup(env)
 
-        if os.path.exists(self.output_dir):
-            shutil.rmtree(self.output_dir)
+def _is_unchanged(output_file: str, entry: Tuple[str, int], digest: str):
+    if entry[0] != digest:
+        return False
+    # Files modified since the last write are rewritten
+    try:
+        return os.stat(output_file).st_mtime_ns == entry[1]
+    except OSError:
+        return False
 
-        for artifact in self.preset.artifacts:
 
-            template = env.get_template(os.path.join(artifact.template_file))
+def _write_file(
+    output_file: str,
+    out: Union[str, "concurrent.futures.Future[str]"],
+    post_process: Optional[Callable[[str], str]],
+    entry: Optional[Tuple[str, int]],
+) -> Tuple[str, int]:
+    content = out.result() if isinstance(out, concurrent.futures.Future) else out
+    if post_process is not None:
+        content = post_process(content)
 
-            for template_variables in artifact.context(input, self.variables):
+    digest = hashlib.blake2b(content.encode()).hexdigest()
+    if entry is not None and _is_unchanged(output_file, entry, digest):
+        return entry
 
-                output_file = env.from_string(artifact.output_file).render(
-                    template_variables
-                )
+    with open(output_file, "w") as f:
+        f.write(content)
+    return digest, os.stat(output_file).st_mtime_ns
 
-                output_file = os.path.join(self.output_dir, output_file)
 
-                # Ensure output_file is located inside output_dir
-                if not Path(self.output_dir) in Path(output_file).parents:
-                    raise ValueError(output_file)
+class Renderer:
+
+    def __init__(self, config: Config) -> None:
+        self.output_dir = os.path.abspath(config.output_dir)
+        self.variables = dict(config.variables)
+        self.preset = config.preset
+
+    def __call__(self, input: RenderInput):
+
+        env = Environment(
+            loader=FileSystemLoader(self.preset.root_dir),
+            # Compiled templates are reused across runs. Without a directory
+            # Jinja uses a private per-user one, bytecode is executed on load.
+            bytecode_cache=FileSystemBytecodeCache(),
+            auto_reload=False,
+        )
+        self.preset.setup(env)
 
-                if not os.path.exists(os.path.dirname(output_file)):
-                    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        # Files whose content did not change since the last render are left
+        # untouched, instead of rebuilding output_dir from scratch
+        previous_manifest = _load_manifest(self.output_dir)
+        manifest = {}
+        self.remove_links()
+
+        # Files are post-processed and written from a thread pool, rendering
+        # the next file overlaps with both. Artifacts with expensive
+        # post-processing (e.g. code formatting) opt into a process pool.
+        use_process_pool = any(
+            artifact.post_process is not None and artifact.post_process_in_process
+            for artifact in self.preset.artifacts
+        )
+        with (
+            (
+                concurrent.futures.ProcessPoolExecutor()
+                if use_process_pool
+                else contextlib.nullcontext()
+            ) as process_pool,
+            concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool,
+        ):
+            writes = []
+            output_dir_prefix = os.path.join(self.output_dir, "")
+            seen_dirs = set()
+            output_names = set()
+
+            for artifact in self.preset.artifacts:
+
+                template = env.get_template(os.path.join(artifact.template_file))
+                output_file_template = env.from_string(artifact.output_file)
+
+                for template_variables in artifact.context(input, self.variables):
+
+                    output_file = output_file_template.render(template_variables)
+
+                    output_file = os.path.abspath(
+                        os.path.join(self.output_dir, output_file)
+                    )
+
+                    # Ensure output_file is located inside output_dir
+                    if not output_file.startswith(output_dir_prefix):
+                        raise ValueError(output_file)
+
+                    output_file_dir = os.path.dirname(output_file)
+                    if output_file_dir not in seen_dirs:
+                        os.makedirs(output_file_dir, exist_ok=True)
+                        seen_dirs.add(output_file_dir)
 
-                with open(output_file, "w") as f:
                     out = template.render(template_variables)
-                    if artifact.post_process is not None:
-                        out = artifact.post_process(out)
-                    f.write(out)
+                    post_process = artifact.post_process
+                    if (
+                        process_pool is not None
+                        and post_process is not None
+                        and artifact.post_process_in_process
+                    ):
+                        out = process_pool.submit(post_process, out)
+                        post_process = None
+
+                    # Writes run concurrently, two contexts rendering to the
+                    # same file (e.g. colliding module names) would race
+                    name = os.path.relpath(output_file, self.output_dir)
+                    if name in output_names:
+                        raise ValueError(output_file)
+                    output_names.add(name)
+
+                    entry = previous_manifest.get(name)
+                    writes.append(
+                        (
+                            name,
+                            pool.submit(
+                                _write_file, output_file, out, post_process, entry
+                            ),
+                        )
+                    )
+
+            # Surface post-processing and write errors
+            for name, write in writes:
+                manifest[name] = write.result()
+
+        self.remove_stale_files(manifest)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def remove_links(self):
+        # Links are replaced by real files and directories, so generated files
+        # always end up inside output_dir
+        for dirpath, dirnames, filenames in os.walk(self.output_dir):
+            for name in [*dirnames, *filenames]:
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    os.remove(path)
+            dirnames[:] = [
+                name for name in dirnames if os.path.isdir(os.path.join(dirpath, name))
+            ]
+
+    def remove_stale_files(self, manifest: Mapping[str, Tuple[str, int]]):
+        for dirpath, dirnames, filenames in os.walk(self.output_dir, topdown=False):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.output_dir)
+                if name != MANIFEST_FILE and name not in manifest:
+                    os.remove(path)
+
+            for dirname in dirnames:
+                path = os.path.join(dirpath, dirname)
+                if not os.listdir(path):
+                    os.rmdir(path)
@@ -1,5 +1,4 @@
-import inspect
-from typing import Generic, Type, TypeVar, TypeGuard, Callable, Any, Type
+from typing import Generic, Type, TypeVar, TypeGuard, Callable, Any, Type, Dict, Tuple
 
 
 __all__ = ["isinstance_predicate", "Visitor"]
@@ -20,12 +19,40 @@ T_Out = TypeVar("T_Out")
 
 
 class Visitor(Generic[T_Node, T_Out]):
+    _visitors: Dict[str, Callable[..., Any]] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        # Flattened over the class hierarchy, subclasses override their bases
+        cls._visitors = {
+            **cls._visitors,
+            **{
+                name[len("visit_") :]: fn
+                for name, fn in vars(cls).items()
+                if name.startswith("visit_") and callable(fn)
+            },
+        }
+
+    def __init__(self) -> None:
+        self._dispatch_cache: Dict[type, Tuple[Callable[[T_Node], T_Out], ...]] = {}
+
+    def _dispatch(self, cls: type) -> Tuple[Callable[[T_Node], T_Out], ...]:
+        # Every matching visitor in MRO order, since a visitor returning
+        # NotImplemented falls through to the next one
+        visitors = []
+        for base in cls.__mro__:
+            fn = self._visitors.get(base.__name__)
+            if fn is not None:
+                visitors.append(fn.__get__(self, type(self)))
+        visitors = self._dispatch_cache[cls] = tuple(visitors)
+        return visitors
+
     def visit(self, node: T_Node) -> T_Out:
-        classes = inspect.getmro(type(node) if not isinstance(node, type) else node)
-        for cls in classes:
-            visitor = getattr(self, "visit_%s" % cls.__name__, None)
-            if visitor is None:
-                continue
+        cls = type(node) if not isinstance(node, type) else node
+        visitors = self._dispatch_cache.get(cls)
+        if visitors is None:
+            visitors = self._dispatch(cls)
+        for visitor in visitors:
             out = visitor(node)
             if out is NotImplemented:
                 continue
@@ -1,42 +1,49 @@
-from typing import Mapping
-import itertools
+from typing import Dict, Iterable, List, Mapping, Optional
 import collections
+import functools
 import os.path
+import re
+import sys
 import jinja2
 import keyword
-from black import format_str, FileMode
-from black.parsing import InvalidInput
 import logging
 
 from fhir_gen import rendering, parsing
 from fhir_gen.rendering import RenderInput
-from fhir_gen.utils import isinstance_predicate
 
 
 ROOT_DIR = os.path.dirname(__file__)
 
 
-def module_name_for_type(type: parsing.FHIRType):
-    if isinstance(type, parsing.FHIRPrimitiveType):
+@functools.lru_cache(maxsize=None)
+def _module_name(url: str, is_primitive: bool) -> str:
+    if is_primitive:
         return "primitives"
 
-    return type.url.split("/")[-1].lower()
+    # Interned, module names are compared and hashed a lot while grouping
+    return sys.intern(url[url.rfind("/") + 1 :].lower())
+
+
+def module_name_for_type(type: parsing.FHIRType):
+    return _module_name(type.url, isinstance(type, parsing.FHIRPrimitiveType))
+
+
+def module_names_for_types(types: Iterable[parsing.FHIRType]) -> Dict[int, str]:
+    # Looked up by id() while rendering, types live as long as the render input
+    return {id(type): module_name_for_type(type) for type in types}
 
 
 @jinja2.pass_context
 def type_reference(context: Mapping, type: parsing.FHIRType):
-    assert "module_name" in context
-    module_name = module_name_for_type(type)
-    reference = type.name
-    if module_name != context["module_name"]:
-        reference = f"{module_name}.{reference}"
-    return reference
+    # Complex type contexts always provide type_references, a missing one
+    # fails on the lookup below
+    return context["type_references"][id(type)]
 
 
 @jinja2.pass_context
 def prop_type_annotation(context: Mapping, prop: parsing.FHIRProperty):
     choices = [f'"{type_reference(context, type)}"' for type in prop.type]
-    annotation = choices[0] if len(choices) == 1 else f"Union[{','.join(choices)}]"
+    annotation = choices[0] if len(choices) == 1 else f"Union[{', '.join(choices)}]"
     if prop.min == 0 and prop.max == 1:
         annotation = f"Optional[{annotation}]"
     elif prop.max == -1:
@@ -44,8 +51,8 @@ def prop_type_annotation(context: Mapping, prop: parsing.FHIRProperty):
     return annotation
 
 
-def prop_name(prop: parsing.FHIRProperty):
-    name = prop.name
+@functools.lru_cache(maxsize=None)
+def _safe_name(name: str) -> str:
     if keyword.iskeyword(name):
         name = f"{name}_"
         assert not keyword.iskeyword(name)
@@ -53,19 +60,51 @@ def prop_name(prop: parsing.FHIRProperty):
     return name
 
 
+def prop_name(prop: parsing.FHIRProperty):
+    return _safe_name(prop.name)
+
+
 class InitContext(rendering.Context):
 
     def __call__(self, input: RenderInput, variables: Mapping):
         return [{**variables}]
 
 
+class TypeIndex:
+    # Classifies the render input in a single pass, shared by the contexts of
+    # a preset so each one doesn't walk all types again
+
+    primitive_types: List[parsing.FHIRPrimitiveType]
+    complex_types: Dict[str, List[parsing.FHIRComplexType]]
+    module_names: Dict[int, str]
+
+    def __init__(self) -> None:
+        self._input: Optional[RenderInput] = None
+
+    def __call__(self, input: RenderInput) -> "TypeIndex":
+        if input is not self._input:
+            self.primitive_types = []
+            self.complex_types = collections.defaultdict(list)
+            for type in input.types:
+                if isinstance(type, parsing.FHIRPrimitiveType):
+                    self.primitive_types.append(type)
+                elif isinstance(type, parsing.FHIRComplexType):
+                    self.complex_types[type.url].append(type)
+
+            self.module_names = module_names_for_types(input.types)
+            self._input = input
+
+        return self
+
+
 class PrimitivesContext(rendering.Context):
 
+    def __init__(self, index: Optional[TypeIndex] = None) -> None:
+        self.index = index or TypeIndex()
+
     def __call__(self, input: RenderInput, variables: Mapping):
 
-        types = list(
-            filter(isinstance_predicate(parsing.FHIRPrimitiveType), input.types)
-        )
+        types = self.index(input).primitive_types
 
         return (
             [
@@ -82,34 +121,69 @@ class PrimitivesContext(rendering.Context):
 
 class ComplexTypeContext(rendering.Context):
 
+    def __init__(self, index: Optional[TypeIndex] = None) -> None:
+        self.index = index or TypeIndex()
+
     def __call__(self, input: RenderInput, variables: Mapping):
-        complex_types = list(
-            filter(isinstance_predicate(parsing.FHIRComplexType), input.types)
-        )
+        index = self.index(input)
+        module_names = index.module_names
 
-        grouped_complex_types = collections.defaultdict(list)
-        for type in complex_types:
-            grouped_complex_types[type.url].append(type)
+        # Largest modules first, they take the longest to post-process
+        for types in sorted(
+            index.complex_types.values(),
+            key=lambda types: sum(len(type.properties) for type in types),
+            reverse=True,
+        ):
 
-        for url, types in grouped_complex_types.items():
+            dependencies = frozenset().union(*(type.dependencies for type in types))
 
-            dependencies = set(itertools.chain(*(type.dependencies for type in types)))
+            module_name = module_names[id(types[0])]
 
-            grouped_dependencies = collections.defaultdict(list)
+            # References to dependencies as written inside this module
+            import_modules = set()
+            type_references = {}
             for type in dependencies:
-                grouped_dependencies[module_name_for_type(type)].append(type)
-            module_name = module_name_for_type(types[0])
+                dependency_module_name = module_names[id(type)]
+                if dependency_module_name == module_name:
+                    type_references[id(type)] = type.name
+                else:
+                    import_modules.add(dependency_module_name)
+                    type_references[id(type)] = f"{dependency_module_name}.{type.name}"
+
             yield {
                 "types": types,
-                "import_modules": set(grouped_dependencies.keys()) - {module_name},
+                "import_modules": sorted(import_modules),
                 "module_name": module_name,
+                "type_references": type_references,
                 **variables,
             }
 
 
+def normalize_py(value: str) -> str:
+    # Templates already emit formatted code, this only cleans up whitespace
+    value = re.sub(r"[ \t]+$", "", value, flags=re.MULTILINE)
+    value = re.sub(r"\n{4,}", "\n\n\n", value).strip("\n")
+    return f"{value}\n" if value else value
+
+
+@functools.cache
+def _black_mode():
+    # Imported here, Black is only needed when formatting is enabled
+    from black import FileMode
+
+    # Templates already emit double quotes and no trailing commas, skip the
+    # passes that would normalize them
+    return FileMode(string_normalization=False, magic_trailing_comma=False)
+
+
+# Identical modules are only formatted once per (worker) process
+@functools.lru_cache(maxsize=4096)
 def post_process_py(value: str) -> str:
+    from black import format_str
+    from black.parsing import InvalidInput
+
     try:
-        return format_str(value, mode=FileMode())
+        return format_str(value, mode=_black_mode())
     except InvalidInput:
         logging.warn("Failed to format %s" % value)
         return value
@@ -119,26 +193,34 @@ class FHIRPydanticPreset(rendering.Preset):
 
     root_dir = ROOT_DIR
 
-    artifacts = [
-        rendering.Artifact(
-            template_file="__init__.py.tmpl",
-            output_file="{{ package_name }}/__init__.py",
-            context=InitContext(),
-            post_process=post_process_py,
-        ),
-        rendering.Artifact(
-            template_file="complex_type.py.tmpl",
-            output_file="{{ package_name }}/{{ module_name }}.py",
-            context=ComplexTypeContext(),
-            post_process=post_process_py,
-        ),
-        rendering.Artifact(
-            template_file="primitives.py.tmpl",
-            output_file="{{ package_name }}/{{ module_name }}.py",
-            context=PrimitivesContext(),
-            post_process=post_process_py,
-        ),
-    ]
+    def __init__(self, black: bool = False) -> None:
+        # Formatting generated code with Black is opt-in
+        post_process = post_process_py if black else normalize_py
+        index = TypeIndex()
+
+        self.artifacts = [
+            rendering.Artifact(
+                template_file="__init__.py.tmpl",
+                output_file="{{ package_name }}/__init__.py",
+                context=InitContext(),
+                post_process=post_process,
+                post_process_in_process=black,
+            ),
+            rendering.Artifact(
+                template_file="complex_type.py.tmpl",
+                output_file="{{ package_name }}/{{ module_name }}.py",
+                context=ComplexTypeContext(index),
+                post_process=post_process,
+                post_process_in_process=black,
+            ),
+            rendering.Artifact(
+                template_file="primitives.py.tmpl",
+                output_file="{{ package_name }}/{{ module_name }}.py",
+                context=PrimitivesContext(index),
+                post_process=post_process,
+                post_process_in_process=black,
+            ),
+        ]
 
     def setup(self, env: rendering.Environment):
         env.filters.update(